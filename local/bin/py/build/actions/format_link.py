@@ -1,9 +1,39 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import re
-import glob
-from optparse import OptionParser
+import sys
+from functools import lru_cache
+
+# All patterns used in the per-line loops are compiled once at import time so
+# that the hot loops don't pay the re cache lookup on every call.
+#
+# The delimiter is part of the tag: tabs and programming-lang shortcodes use
+# {{< >}} while tab uses {{% %}}, and other pairings must not change state.
+SECTION_TAG_REGEX = re.compile(
+    r"{{(?:< (/?)(tabs|programming-lang-wrapper|programming-lang)"
+    r"|% (/?)(tab))\b")
+
+# Tags that open a tabs-like group and tags that open a single tab within
+# such a group. Frozensets give O(1) membership tests in the parse loop.
+SECTION_TAGS = frozenset(('tabs', 'programming-lang-wrapper'))
+TAB_TAGS = frozenset(('tab', 'programming-lang'))
+BOTTOM_REFERENCE_LINK_REGEX = re.compile(r"^\s*\[(\d*?)\]: (\S*)")
+REFERENCE_USAGE_REGEX = re.compile(r"\]\[(\d*)\]")
+INLINED_LINK_REGEX = re.compile(r"\[.*?\]\((?![#?])(\S*?)\)", re.MULTILINE)
+END_SECTION_REGEX = re.compile(r"\s*(?:{{% /tab %}}|{{< /programming-lang >}})")
+
+# ANSI colored labels are only emitted on a terminal; redirected output
+# (CI logs, pipes) gets the plain level names.
+if sys.stdout.isatty():
+    ERROR_LABEL = '\x1b[31mERROR\x1b[0m'
+    WARNING_LABEL = '\x1b[33mWARNING\x1b[0m'
+    INFO_LABEL = '\x1b[32mINFO\x1b[0m'
+else:
+    ERROR_LABEL = 'ERROR'
+    WARNING_LABEL = 'WARNING'
+    INFO_LABEL = 'INFO'
 
 
 def prepare_file(file):
@@ -27,26 +57,47 @@ def prepare_file(file):
     sub_sections = []
     temp_section = []
 
+    # Reading the file in one go is cheaper than iterating the file object
+    # line by line, which refills an 8KB buffer and decodes per chunk.
     with open(file, 'r', encoding='utf-8') as f:
-        for line in f:
-            if state == 'main':
-                main_section.append(line)
-                if (re.search(r"{{< tabs >}}", line.strip()) or re.search(r"{{< programming-lang-wrapper", line.strip())):
-                    state = 'tabs'
-            elif state == 'tabs':
+        text = f.read()
+
+    lines = text.splitlines(keepends=True)
+
+    # One scan over the whole text tells whether the file opens a tabs-like
+    # group at all; most files don't and are a single main section, so the
+    # per-line state machine below never has to run for them.
+    for match in SECTION_TAG_REGEX.finditer(text):
+        if match.group(2) in SECTION_TAGS:
+            break
+    else:
+        return [lines]
+
+    for line in lines:
+        # Most markdown lines carry no shortcode at all, so a cheap
+        # substring test avoids the regex scan entirely on those lines.
+        match = SECTION_TAG_REGEX.search(line) if '{{' in line else None
+        is_closing_tag = bool(match and (match.group(1) or match.group(3)))
+        tag_name = (match.group(2) or match.group(4)) if match else None
+
+        if state == 'main':
+            main_section.append(line)
+            if not is_closing_tag and tag_name in SECTION_TAGS:
+                state = 'tabs'
+        elif state == 'tabs':
+            main_section.append(line)
+            if not is_closing_tag and tag_name in TAB_TAGS:
+                state = 'tab'
+            if is_closing_tag and tag_name in SECTION_TAGS:
+                state = 'main'
+        elif state == 'tab':
+            if is_closing_tag and tag_name in TAB_TAGS:
+                state = 'tabs'
                 main_section.append(line)
-                if (re.search(r"{{% tab ", line.strip()) or re.search(r"{{< programming-lang ", line.strip())):
-                    state = 'tab'
-                if (re.search(r"{{< /tabs >}}", line.strip()) or re.search(r"{{< /programming-lang-wrapper >}}", line.strip())):
-                    state = 'main'
-            elif state == 'tab':
-                if (re.search(r"{{% /tab %}}", line.strip()) or re.search(r"{{< /programming-lang >}}", line.strip())):
-                    state = 'tabs'
-                    main_section.append(line)
-                    sub_sections.append(temp_section)
-                    temp_section = []
-                else:
-                    temp_section.append(line)
+                sub_sections.append(temp_section)
+                temp_section = []
+            else:
+                temp_section.append(line)
 
     if state != 'main':
         raise ValueError
@@ -62,17 +113,22 @@ def check_references(all_references):
     :return all_references_deduped: An array of references deduped.
     """
     all_references_deduped = []
-    reference_indexes_used = []
+    references_seen = set()
+    reference_indexes_used = set()
     duplicated_references = []
     is_duplicated = False
 
+    # Sets give O(1) membership tests where the list lookups used to make
+    # this loop quadratic in the number of references.
+
     for reference in all_references:
-        if reference not in all_references_deduped:
+        if reference not in references_seen:
+            references_seen.add(reference)
 
             reference_index, reference_val = reference
 
             if reference_index not in reference_indexes_used:
-                reference_indexes_used.append(reference_index)
+                reference_indexes_used.add(reference_index)
                 all_references_deduped.append(reference)
             else:
                 duplicated_references.append(reference)
@@ -96,35 +152,52 @@ def remove_reference(section, regex_skip_sections_start,
     :param section: An array of lines representing a section.
     :param regex_skip_sections_start: regex defining the start line that indicates a block of line that shouldn't be processed.
     :param regex_skip_sections_end: regex defining the end line that indicates a block of line that shouldn't be processed.
-    :return [all_references, section_without_references]: Returns an array of array, the first item contains all references found in the section
-                                                          The second item contains the section without any reference in it.
+    :return [all_references, section_without_references, skip_mask]: Returns an array, the first item contains all references found in the section,
+                                                                     the second item contains the section without any reference in it,
+                                                                     the third item flags for each remaining line whether it belongs to a skip block.
     """
     skip = False
     all_references = []
     section_without_references = []
-    regex_bottom_reference_link = r"^\s*\[(\d*?)\]: (\S*)"
+    skip_mask = []
 
     # Collecting all references and removing them from section
     # looking at each line, if a line is a reference then we remove it and store the reference.
+    # The skip flags are recorded per remaining line so the following passes
+    # don't have to evaluate the skip regexes all over again.
 
     for line in section:
         if skip:
             section_without_references.append(line)
-            if re.search(regex_skip_sections_end, line):
+            skip_mask.append(True)
+            if regex_skip_sections_end.search(line):
                 skip = False
         elif not skip:
 
-            if re.search(regex_skip_sections_start, line):
+            if regex_skip_sections_start.search(line):
                 section_without_references.append(line)
+                skip_mask.append(True)
                 skip = True
 
-            elif re.search(regex_bottom_reference_link, line):
-
-                reference = re.search(regex_bottom_reference_link, line)
-                all_references.append([reference.group(1),
-                                       reference.group(2)])
             else:
-                section_without_references.append(line)
+
+                # ']: ' appears in every footer reference, so the substring
+                # test keeps the regex away from ordinary lines, and the
+                # match is searched once and reused for the capture groups.
+
+                reference = (BOTTOM_REFERENCE_LINK_REGEX.search(line)
+                             if ']: ' in line else None)
+
+                if reference:
+
+                    # Tuples so the references can live in the sets used by
+                    # check_references.
+
+                    all_references.append((reference.group(1),
+                                           reference.group(2)))
+                else:
+                    section_without_references.append(line)
+                    skip_mask.append(False)
     # By the end of the for loop skip should always be false otherwise it means that a codeblock is not closed.
     if skip:
         raise ValueError
@@ -134,129 +207,122 @@ def remove_reference(section, regex_skip_sections_start,
     except AssertionError:
         raise AssertionError
 
-    return [all_references_checked, section_without_references]
+    return [all_references_checked, section_without_references, skip_mask]
 
 
 def inlining_all_links(
         section_without_references,
         all_references,
-        regex_skip_sections_start,
-        regex_skip_sections_end):
+        skip_mask):
     """
     Goes through a section with a list of references and inline all references.
 
     :param section_without_references: An array of lines representing a section, for this function to work, all reference should be removed previously from the section.
-    :param regex_skip_sections_start: regex defining the start line that indicates a block of line that shouldn't be processed.
-    :param regex_skip_sections_end: regex defining the end line that indicates a block of line that shouldn't be processed.
+    :param all_references: A dict mapping reference indexes to their links.
+    :param skip_mask: An array of booleans flagging the lines that belong to a block that shouldn't be processed.
     :return section_with_all_links: A section (an array of lines) is returned without any references in it, just pure inlined links.
     """
 
     section_with_all_links = []
-    skip = False
 
-    for line in section_without_references:
-        if skip:
-            if re.search(regex_skip_sections_end, line):
-                skip = False
-        elif not skip:
-            if re.search(regex_skip_sections_start, line):
-                skip = True
-            else:
-                for reference in all_references:
-                    reference_index, reference_val = reference
+    def inline_reference(match):
+        reference_val = all_references.get(match.group(1))
+        if reference_val is None:
+            return match.group(0)
+        return '](' + reference_val + ')'
 
-                    curent_link = '][' + reference_index + ']'
+    for line, skip in zip(section_without_references, skip_mask):
+        if not skip and '][' in line:
 
-                    line = line.replace(
-                        curent_link, '](' + reference_val + ')')
+            # A single substitution scans the line once instead of one
+            # full str.replace pass per known reference. The substring
+            # test skips lines that cannot hold a reference usage.
 
-        section_with_all_links.append(line)
+            line = REFERENCE_USAGE_REGEX.sub(inline_reference, line)
 
-    # By the end of the for loop skip should always be false otherwise it means that a codeblock is not closed.
-    if skip:
-        raise ValueError
+        section_with_all_links.append(line)
 
     return section_with_all_links
 
 
-def collect_all_links(section_with_all_links,
-                      regex_skip_sections_start,
-                      regex_skip_sections_end):
+def collect_all_links(section_with_all_links, skip_mask):
     """
     Goes through a section and extract all inlined links it can found.
 
     :param section_with_all_links: An array of lines representing a section. For this function to work, all links must be inlined first.
-    :param regex_skip_sections_start: regex defining the start line that indicates a block of line that shouldn't be processed.
-    :param regex_skip_sections_end: regex defining the end line that indicates a block of line that shouldn't be processed.
+    :param skip_mask: An array of booleans flagging the lines that belong to a block that shouldn't be processed.
     :return all_links: An array of all unique links that where found within a section.
     """
-    regex_link_inlined = r"\[.*?\]\((?![#?])(\S*?)\)"
-    all_links = []
-    skip = False
-    for line in section_with_all_links:
-        if skip:
-            if re.search(regex_skip_sections_end, line):
-                skip = False
-        elif not skip:
-            if re.search(regex_skip_sections_start, line):
-                skip = True
-            else:
-                line_links = re.findall(regex_link_inlined, line,
-                                        re.MULTILINE)
-                if not line_links == []:
-                    for link in line_links:
+    # Dict keys keep insertion order, so one structure both dedupes the
+    # links and preserves their first-appearance order for the numbering.
 
-                        # If the link is already in the array, then it doesn't add it to avoid duplicated link
+    all_links = {}
 
-                        if link not in all_links:
-                            all_links.append(link)
+    for line, skip in zip(section_with_all_links, skip_mask):
+        if not skip and '](' in line:
+
+            # '](' is part of any inlined link, so lines without it
+            # never reach the regex.
+
+            for link in INLINED_LINK_REGEX.findall(line):
+                all_links[link] = None
+
+    return list(all_links)
 
-    # By the end of the for loop skip should always be false otherwise it means that a codeblock is not closed.
-    if skip:
-        raise ValueError
 
-    return all_links
+@lru_cache(maxsize=1024)
+def build_link_replacements(all_links):
+    """
+    Builds the substitution turning inlined links into their references, numbered from 1.
+    Tabs within a page usually share the same links, so results are memoized per link tuple.
+    The cache is bounded: link tuples rarely repeat across files, so an unbounded cache
+    would only grow for the life of the process.
+
+    :param all_links: A tuple of links, in the order their reference indexes should follow.
+    :return [link_regex, link_replacements]: A regex matching any of the inlined links, and a dict
+                                             mapping each link to its reference.
+    """
+    if not all_links:
+        return None, {}
+
+    link_regex = re.compile(r"\]\((" + "|".join(re.escape(str(link))
+                                                for link in all_links) + r")\)")
+    link_replacements = {str(link): '][' + str(i) + ']'
+                         for i, link in enumerate(all_links, 1)}
+
+    return link_regex, link_replacements
 
 
 def transform_link_to_references(
     section_with_all_links,
     all_links,
-    regex_skip_sections_start,
-    regex_skip_sections_end,
+    skip_mask,
 ):
     """
     Goes through a section where all link are inlined and transform them in references
 
     :param section_with_all_links: An array of lines representing a section where all link are inlined.
     :param all_links: An array of links representing all unique list associated to section_with_all_links.
-    :param regex_skip_sections_start: regex defining the start line that indicates a block of line that shouldn't be processed.
-    :param regex_skip_sections_end: regex defining the end line that indicates a block of line that shouldn't be processed.
+    :param skip_mask: An array of booleans flagging the lines that belong to a block that shouldn't be processed.
     :return section_with_references: A section (an array of lines), with all inlined links transformed into a reference link.
     """
 
     section_with_references = []
 
-    skip = False
+    link_regex, link_replacements = build_link_replacements(tuple(all_links))
 
-    for line in section_with_all_links:
-        if skip:
-            if re.search(regex_skip_sections_end, line):
-                skip = False
-        elif not skip:
-            if re.search(regex_skip_sections_start, line):
-                skip = True
-            else:
-                for i, link in enumerate(all_links):
-                    link_to_reference = '](' + str(link) + ')'
-                    # i is incremented by one in order to start references indexes at 1
-                    line = line.replace(link_to_reference,
-                                        '][' + str(i + 1) + ']')
+    def replace_link(match):
+        return link_replacements[match.group(1)]
 
-        section_with_references.append(line)
+    for line, skip in zip(section_with_all_links, skip_mask):
+        if not skip and link_regex and '](' in line:
 
-    # By the end of the for loop skip should always be false otherwise it means that a codeblock is not closed.
-    if skip:
-        raise ValueError
+            # One alternation substitution replaces every known link in
+            # a single scan instead of one str.replace pass per link.
+
+            line = link_regex.sub(replace_link, line)
+
+        section_with_references.append(line)
 
     return section_with_references
 
@@ -271,44 +337,66 @@ def process_section(section, regex_skip_sections_start,
     :param regex_skip_sections_end: regex defining the end line that indicates a block of line that shouldn't be processed.
     :return section_with_references: Returns the section but with all link set as reference.
     """
+
+    # '](' (inlined link), '][' (reference usage), and ']: ' (footer
+    # reference) are the only markers the passes below act on; a section
+    # containing none of them comes back untouched. Skip blocks are still
+    # validated so an unclosed one errors here like it does everywhere else.
+
+    if not any('](' in line or '][' in line or ']: ' in line
+               for line in section):
+        skip = False
+        for line in section:
+            if skip:
+                if regex_skip_sections_end.search(line):
+                    skip = False
+            elif regex_skip_sections_start.search(line):
+                skip = True
+        if skip:
+            print(ERROR_LABEL + ': A skip section is not closed')
+            raise ValueError
+        return list(section)
+
     try:
-        all_references, section_without_references = remove_reference(
-            section, regex_skip_sections_start, regex_skip_sections_end)
+        all_references, section_without_references, skip_mask = \
+            remove_reference(section, regex_skip_sections_start,
+                             regex_skip_sections_end)
     except AssertionError:
-        print('\x1b[31mERROR\x1b[0m: Some references are duplicated.')
+        print(ERROR_LABEL + ': Some references are duplicated.')
         raise AssertionError
     except ValueError:
-        print('\x1b[31mERROR\x1b[0m: A skip section is not closed')
+        print(ERROR_LABEL + ': A skip section is not closed')
         raise ValueError
 
+    # A plain dict is all the ordering guarantee needed here: it keeps the
+    # insertion order of the checked references and gives O(1) index lookups.
+
+    all_references = dict(all_references)
+
     # Inlining refrences
     # Looking at each line, it replaces reference link [.*][\d] by the full inlined link
 
     section_with_all_links = \
         inlining_all_links(section_without_references, all_references,
-                           regex_skip_sections_start,
-                           regex_skip_sections_end)
+                           skip_mask)
 
     # Collecting all links from file
     # Looking at each line, it extracts all links it can found and add it to all_links array
 
-    all_links = collect_all_links(section_with_all_links,
-                                  regex_skip_sections_start,
-                                  regex_skip_sections_end)
+    all_links = collect_all_links(section_with_all_links, skip_mask)
 
     # Now that all link are extracted, it creates a new section with all inlined referenced link
 
     section_with_references = \
         transform_link_to_references(section_with_all_links, all_links,
-                                     regex_skip_sections_start, regex_skip_sections_end)
-
-    # Finally it adds all refrerences at the end of the section
+                                     skip_mask)
 
-    for i, link in enumerate(all_links):
+    # Finally it adds all refrerences at the end of the section in one go,
+    # numbering them from 1.
 
-        # 1 is added to i in order to start references link index at 1 instead of 0
-
-        section_with_references.append('[' + str(i + 1) + ']: ' + link + '\n')
+    section_with_references.extend(
+        '[' + str(i) + ']: ' + link + '\n'
+        for i, link in enumerate(all_links, 1))
 
     return section_with_references
 
@@ -324,20 +412,22 @@ def inline_section(file_prepared):
 
     final_text = []
 
-    end_section_pattern = r"\s*{{% /tab %}}.*"
-    end_lang_section_pattern = r"\s*{{< /programming-lang >}}.*"
-
     i = 1
 
     try:
         for line in file_prepared[0]:
-            if (re.match(end_section_pattern, line) or re.match(end_lang_section_pattern, line)):
+            if END_SECTION_REGEX.match(line):
                 final_text += file_prepared[i]
                 i += 1
             final_text.append(line)
     except:
         raise ValueError
 
+    # Every sub section must have been spliced back behind its closing tag;
+    # a leftover one means the file would be written back truncated.
+    if i != len(file_prepared):
+        raise ValueError
+
     return ''.join(final_text)
 
 
@@ -352,10 +442,16 @@ def format_link_file(file, regex_skip_sections_start,
     :return final_text: Returns the file but with all links set as reference.
     """
 
+    # The skip patterns come in as strings through the public signature;
+    # compiling them once here serves every per-line check below.
+
+    regex_skip_sections_start = re.compile(regex_skip_sections_start)
+    regex_skip_sections_end = re.compile(regex_skip_sections_end)
+
     try:
         prepared_file = prepare_file(file)
     except ValueError:
-        print("\x1b[31mERROR\x1b[0m: Couldn't split the file into multiple section correctly for file: {}".format(file))
+        print(ERROR_LABEL + ": Couldn't split the file into multiple section correctly for file: {}".format(file))
         raise ValueError
 
     final_text = []
@@ -367,20 +463,79 @@ def format_link_file(file, regex_skip_sections_start,
                                               regex_skip_sections_end))
         except:
             print(
-                '\x1b[31mERROR\x1b[0m: There was an issue processing a section for file: {}'.format(file))
+                ERROR_LABEL + ': There was an issue processing a section for file: {}'.format(file))
             raise ValueError
 
     try:
         file_with_references = inline_section(final_text)
     except ValueError:
         print(
-            '\x1b[31mERROR\x1b[0m: Could not inline sections properly for file: {}'.format(file))
+            ERROR_LABEL + ': Could not inline sections properly for file: {}'.format(file))
         raise ValueError
 
     return file_with_references
 
 
+def iter_markdown_files(directory):
+    """
+    Recursively yields the path of every markdown file under a directory.
+
+    :param directory: Directory to walk.
+    :return: Yields .md file paths as strings.
+    """
+
+    # os.scandir streams entries together with their file type, avoiding the
+    # per-entry Path construction and extra stat calls of Path.rglob.
+
+    pending_directories = [directory]
+
+    while pending_directories:
+        try:
+            entries = os.scandir(pending_directories.pop())
+        except OSError:
+            # Unreadable or vanished directories are skipped, like glob did.
+            continue
+        with entries:
+            for entry in entries:
+                # glob's ** never matches hidden entries; keep .git, .github
+                # and friends out of the walk the same way.
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    pending_directories.append(entry.path)
+                elif entry.name.endswith('.md') and entry.is_file(follow_symlinks=False):
+                    yield entry.path
+
+
+def format_link_directory_file(args):
+    """
+    Worker used when formatting a whole directory: processes one file and returns the result
+    so the parent process can do the actual write.
+
+    :param args: Tuple of (filepath, regex_skip_sections_start, regex_skip_sections_end).
+    :return [filepath, final_text, changed]: final_text is None when the file couldn't be processed,
+                                             changed is False when the file is already formatted.
+    """
+    filepath, regex_skip_sections_start, regex_skip_sections_end = args
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            original_text = f.read()
+        final_text = format_link_file(filepath,
+                                      regex_skip_sections_start,
+                                      regex_skip_sections_end)
+    except Exception:
+        return filepath, None, False
+    return filepath, final_text, final_text != original_text
+
+
 if __name__ == '__main__':
+
+    # Only the command line entry point needs these; importers of the
+    # module (the pre-build actions, the tests) skip loading them.
+
+    from concurrent.futures import ProcessPoolExecutor
+    from optparse import OptionParser
+
     parser = OptionParser(usage='usage: %prog [options] file')
     parser.add_option('-f', '--file',
                       help='File to format link in reference',
@@ -397,26 +552,40 @@ if __name__ == '__main__':
         try:
             final_text = format_link_file(options.file,
                                           regex_skip_sections_start, regex_skip_sections_end)
-            with open(options.file, 'w') as final_file:
+            with open(options.file, 'w', buffering=1 << 20,
+                      encoding='utf-8') as final_file:
                 final_file.write(final_text)
         except:
-            print('\x1b[31mERROR\x1b[0m: Processing file {}'.format(
+            print(ERROR_LABEL + ': Processing file {}'.format(
                 options.file))
 
     elif options.directory:
-        for filepath in glob.iglob(options.directory + '**/*.md',
-                                   recursive=True):
 
-            print('\x1b[32mINFO\x1b[0m: Formating file {}'.format(filepath))
-            try:
-                final_text = format_link_file(filepath,
-                                              regex_skip_sections_start,
-                                              regex_skip_sections_end)
-                with open(filepath, 'w') as final_file:
-                    final_file.write(final_text)
-            except:
-                print(
-                    '\x1b[31mERROR\x1b[0m: Processing file {}'.format(filepath))
+        # Every file is independent, so directory runs are spread over all
+        # cores. Workers only format; writes stay in the parent process.
+
+        files = [(filepath, regex_skip_sections_start,
+                  regex_skip_sections_end)
+                 for filepath in iter_markdown_files(options.directory)]
+
+        if not files:
+            print(WARNING_LABEL + ': No markdown file found in {}'.format(
+                options.directory))
+
+        # chunksize batches the dispatch to the workers so the IPC cost is
+        # amortized over many small files.
+
+        with ProcessPoolExecutor() as executor:
+            for filepath, final_text, changed in executor.map(
+                    format_link_directory_file, files, chunksize=16):
+                if final_text is None:
+                    print(
+                        ERROR_LABEL + ': Processing file {}'.format(filepath))
+                elif changed:
+                    print(INFO_LABEL + ': Formating file {}'.format(filepath))
+                    with open(filepath, 'w', buffering=1 << 20,
+                              encoding='utf-8') as final_file:
+                        final_file.write(final_text)
 
     else:
-        print('\x1b[31mERROR\x1b[0m: Please specify a file or a directory')
+        print(ERROR_LABEL + ': Please specify a file or a directory')
@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 import pytest
 from format_link import format_link_file
-import os
 
 regex_skip_sections_end = r"(```|\{\{< \/code-block >\}\})"
 regex_skip_sections_start = r"(```|\{\{< code-block)"
@@ -62,13 +61,90 @@ This is a reference [link][2]
 """
 
 
-def test_format_link(tmp_path):
+data_to_test_simple = """
+---
+title: This is a title
+kind: documentation
+---
+
+This is an [inlined link](/inlined_link). This is a reference [link][1]
+
+[1]: /reference_link_1
+"""
+
+expected_data_simple = """
+---
+title: This is a title
+kind: documentation
+---
+
+This is an [inlined link][1]. This is a reference [link][2]
+
+[1]: /inlined_link
+[2]: /reference_link_1
+"""
+
+data_to_test_lang = """
+---
+title: This is a title
+kind: documentation
+---
+
+Main section [link](/main_link)
+
+{{< programming-lang-wrapper langs="java,python" >}}
+{{< programming-lang lang="java" >}}
+
+Java section [link](/java_link) and [reference][1]
+
+[1]: /java_reference
+
+{{< /programming-lang >}}
+{{< /programming-lang-wrapper >}}
+
+[1]: /java_reference
+"""
+
+expected_data_lang = """
+---
+title: This is a title
+kind: documentation
+---
+
+Main section [link][1]
+
+{{< programming-lang-wrapper langs="java,python" >}}
+{{< programming-lang lang="java" >}}
+
+Java section [link][1] and [reference][2]
+
+
+[1]: /java_link
+[2]: /java_reference
+{{< /programming-lang >}}
+{{< /programming-lang-wrapper >}}
+
+[1]: /main_link
+"""
+
+
+# The case table lives at module scope, next to the data it pairs up, so
+# it is built once at import and stays reusable for future tests.
+format_link_cases = [
+    pytest.param(data_to_test, expected_data, id="tabs"),
+    pytest.param(data_to_test_simple, expected_data_simple, id="simple"),
+    pytest.param(data_to_test_lang, expected_data_lang, id="programming_lang"),
+]
+
+
+@pytest.mark.parametrize("data,expected", format_link_cases)
+def test_format_link(tmp_path, data, expected):
     tmp_directory = tmp_path / "tests"
     tmp_directory.mkdir()
 
     bad_file = tmp_directory / "bad_file.md"
 
-    bad_file.write_text(data_to_test)
+    bad_file.write_text(data)
 
-    assert expected_data == format_link_file(
+    assert expected == format_link_file(
         bad_file, regex_skip_sections_start, regex_skip_sections_end)